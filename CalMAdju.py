@@ -22,6 +22,16 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import sys
 from calmadju.core import Core
 
+def positive_int(value):
+    """Argument type for strictly positive integers."""
+    import argparse
+
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{0} is not a positive number".format(value))
+    return number
+
+
 def run(argv=sys.argv):
     """Wrapper script to run CalMAdju, adds command line interface.
 
@@ -41,10 +51,38 @@ def run(argv=sys.argv):
                         "taken images)")
     parser.add_argument("--manual-setting", dest="manual", action="store_true",
                         help="change the camera's settings manually instead of trying to script it")
+    parser.add_argument("--stream", dest="stream", action="store_true",
+                        help="stream previously taken images through the analysis one at a time "
+                        "(bounded memory, implies --no-camera)")
+    parser.add_argument("--no-prescreen", dest="prescreen", action="store_false",
+                        help="score every frame at full resolution instead of rejecting "
+                        "obviously bad ones on a downsampled version first")
+    parser.add_argument("-w", "--window", dest="window", metavar=("W", "H"), type=positive_int,
+                        nargs=2, default=None, help="half width and height (pixels) of the region "
+                        "around the image center to evaluate (default: 900 600, or pick it "
+                        "on the reference image)")
     parser.add_argument("-b", "--batch-mode", dest="batch", action="store_true",
                         help="run in batch mode without user interaction")
     parser.add_argument("-i", "--image_path", metavar="PATH", type=str, default="images",
                         help="path to store/read images to/from")
+    parser.add_argument("-r", "--results_path", metavar="PATH", type=str, default="results",
+                        help="path to store/query sweep results")
+    parser.add_argument("--camera", dest="camera", type=str, default=None,
+                        help="camera model to record with the results, e.g. when analysing "
+                        "previously taken images (default: the detected camera)")
+    parser.add_argument("--lens", dest="lens", type=str, default=None,
+                        help="name of the lens to record with the results (default: ask the camera)")
+    parser.add_argument("--focal-length", dest="focal_length", type=float, default=None,
+                        help="focal length (mm) to record with the results")
+    parser.add_argument("--query-drift", dest="query", metavar="CAMERA", type=str, default=None,
+                        help="show the optimum recorded for a camera (and --lens) over time, "
+                        "then exit")
+    parser.add_argument("--scoring-server", dest="scoring_url", metavar="URL", type=str,
+                        default=None, help="let a running scoring service (see --serve) "
+                        "score the images, e.g. http://127.0.0.1:8765")
+    parser.add_argument("--serve", dest="serve", metavar="PORT", type=int, nargs="?",
+                        const=8765, default=None,
+                        help="run as local scoring service on the given port, then exit")
     parser.add_argument("-v", "--version", action="version", version="%(prog)s version: BETA",
                         help="show version")
 
@@ -52,9 +90,23 @@ def run(argv=sys.argv):
     parser.set_defaults(nocamera=False)
     parser.set_defaults(batch=False)
     parser.set_defaults(manual=False)
+    parser.set_defaults(stream=False)
+    parser.set_defaults(prescreen=True)
 
     args = parser.parse_args()
 
+    # Run as scoring service?
+    if args.serve is not None:
+        from calmadju.service_helper import ScoringServer
+        ScoringServer(port=args.serve).serve_forever()
+        return
+
+    # Only query previous results?
+    if args.query is not None:
+        from calmadju.results_helper import Results
+        Results(args.results_path).print_drift(args.query, lens=args.lens)
+        return
+
     # convert argument list in something Core understands
     metric_list = []
     for metric in args.metric:
@@ -67,8 +119,15 @@ def run(argv=sys.argv):
 
     # Run main script
     runner = Core(base_dir=args.image_path, batch_mode=args.batch, metrics=metric_list,
-                  gp_cameraless_mode=args.nocamera, gp_camerasafe_mode=args.manual)
-    runner.main()
+                  gp_cameraless_mode=args.nocamera or args.stream,
+                  gp_camerasafe_mode=args.manual, results_dir=args.results_path,
+                  camera=args.camera, lens=args.lens, focal_length=args.focal_length,
+                  scoring_url=args.scoring_url, prescreen=args.prescreen,
+                  window=args.window)
+    if args.stream:
+        runner.stream_main()
+    else:
+        runner.main()
 
 
 if __name__ == "__main__":
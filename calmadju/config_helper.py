@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+This file is part of CalMAdju.
+
+Copyright (C) 2016-2017 di-br@users.noreply.github.com
+                        https://github.com/di-br/CalMAdju
+
+CalMAdju is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Have new print 'statements' (Python 3.0)
+from __future__ import print_function
+# The cache is plain JSON
+import json
+# to fiddle with file paths
+import os
+# Use regex to do some filtering and splitting
+import re
+from collections import OrderedDict
+
+# Config entries we need
+CUSTOMFUNCEX_PATH = "/main/settings/customfuncex"
+MODEL_PATH = "/main/status/cameramodel"
+FIRMWARE_PATH = "/main/status/deviceversion"
+
+# Confirmed layouts of the AF microadjustment within customfuncex, per camera
+# model: the custom function holding it, its number of values, and the
+# position of the adjustment value within those values. Other cameras can
+# learn theirs, see CameraConfig.learn_af_microadjustment()
+AF_MICROADJUSTMENT_LAYOUTS = {}
+AF_MICROADJUSTMENT_LAYOUTS['Canon EOS 7D'] = (0x507, 5, 2)
+
+# Default location of the config cache
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".calmadju", "cameras")
+
+
+def parse_config(lines):
+    """ Parse the output of 'gphoto2 --list-all-config'.
+
+    Returns an ordered dictionary mapping config paths to dictionaries of their
+    fields (label, readonly, type, current, and a list of choices).
+    """
+
+    config = OrderedDict()
+    entry = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("/"):
+            entry = {"choices": []}
+            config[line.strip()] = entry
+        elif entry is None:
+            # Skip anything before the first entry
+            continue
+        elif line.strip() == "END":
+            entry = None
+        elif ":" in line:
+            key, value = line.split(":", 1)
+            key = key.strip().lower()
+            value = value.strip()
+            if key == "choice":
+                entry["choices"].append(value)
+            else:
+                entry[key] = value
+
+    return config
+
+
+def parse_customfuncex(customfuncex):
+    """ Split a customfuncex string into its custom functions.
+
+    The string is a comma separated list of hex numbers: total size, number
+    of groups, then per group its id, size, and number of functions, then per
+    function its id, number of values, and the values.
+    Returns a list of (function id, number of values, index of the first
+    value within the comma separated list) tuples. Raises ValueError if the
+    string cannot be parsed.
+    """
+
+    tokens = customfuncex.strip().strip(",").split(",")
+    functions = []
+    try:
+        position = 1
+        n_groups = int(tokens[position], 16)
+        position += 1
+        for _ in range(n_groups):
+            # Skip group id and size
+            position += 2
+            n_functions = int(tokens[position], 16)
+            position += 1
+            for _ in range(n_functions):
+                function_id = int(tokens[position], 16)
+                n_values = int(tokens[position + 1], 16)
+                functions.append((function_id, n_values, position + 2))
+                position += 2 + n_values
+    except (IndexError, ValueError):
+        raise ValueError("Cannot parse customfuncex value")
+
+    if position > len(tokens):
+        raise ValueError("customfuncex value is too short")
+
+    return functions
+
+
+def locate_customfuncex_value(customfuncex, function, n_values, offset):
+    """ Find the value of a custom function within a customfuncex string.
+
+    Returns the index (within the comma separated list) of the requested
+    value. Raises ValueError if the string cannot be parsed or does not
+    contain the function with the expected number of values.
+    """
+
+    for function_id, n_function_values, start in parse_customfuncex(customfuncex):
+        if function_id == function:
+            if n_function_values != n_values:
+                raise ValueError("Custom function {0:x} has {1} values, expected "
+                                 "{2}".format(function, n_function_values, n_values))
+            return start + offset
+
+    raise ValueError("Custom function {0:x} not found".format(function))
+
+
+def same_customfuncex(first, second):
+    """ Whether two customfuncex values are equal (comparing the numbers, not
+    their spelling).
+    """
+
+    def numbers(value):
+        return [int(token, 16) for token in value.strip().strip(",").split(",")]
+
+    try:
+        return numbers(first) == numbers(second)
+    except ValueError:
+        return False
+
+
+def hex_value(value):
+    """ Spell an adjustment value the way customfuncex does (one byte, two's
+    complement).
+    """
+
+    if value >= 0:
+        return "%02x" % value
+    return "%02x" % (256 + value)
+
+
+def find_changed_value(before, after, value_before, value_after):
+    """ Find the layout of a setting from two customfuncex values taken before
+    and after changing (only) that setting on the camera.
+
+    Returns a (function id, number of values, offset) tuple. Raises
+    ValueError unless both values have the same layout and exactly one value
+    changed, from value_before to value_after.
+    """
+
+    functions = parse_customfuncex(before)
+    if parse_customfuncex(after) != functions:
+        raise ValueError("The layout of the custom functions changed")
+
+    tokens_before = before.strip().strip(",").split(",")
+    tokens_after = after.strip().strip(",").split(",")
+    changed = [index for index in range(len(tokens_before))
+               if int(tokens_before[index], 16) != int(tokens_after[index], 16)]
+    if len(changed) != 1:
+        raise ValueError("Expected one changed value, found {0}".format(len(changed)))
+
+    index = changed[0]
+    if int(tokens_before[index], 16) != int(hex_value(value_before), 16) or \
+       int(tokens_after[index], 16) != int(hex_value(value_after), 16):
+        raise ValueError("The changed value does not match the adjustments made")
+
+    for function_id, n_values, start in functions:
+        if start <= index < start + n_values:
+            return function_id, n_values, index - start
+
+    raise ValueError("The changed value is not part of any custom function")
+
+
+class CameraConfig(object):
+    """ Class keeping the config tree of a camera, cached on disk per body and
+    firmware.
+
+    Once it knows where the AF microadjustment lives within the customfuncex
+    value (confirmed in AF_MICROADJUSTMENT_LAYOUTS or learned from the
+    camera), changing it only takes a local patch and a single write.
+    """
+
+
+    def __init__(self, config, af_layout=None, cache_file=None):
+        # Config tree as returned by parse_config()
+        self._config = config
+        # Layout of the AF microadjustment learned from this camera (if any)
+        self._af_layout = af_layout
+        # Where this config is cached (if it is)
+        self._cache_file = cache_file
+        # Current customfuncex value, split into its parts
+        self._customfuncex = None
+        # Index of the AF microadjustment value within those parts
+        self._af_index = None
+
+        if CUSTOMFUNCEX_PATH in self._config:
+            self.set_customfuncex(self._config[CUSTOMFUNCEX_PATH].get("current", ""))
+
+
+    @classmethod
+    def from_dump(cls, filename):
+        """ Read a recorded 'gphoto2 --list-all-config' dump. """
+
+        with open(filename) as dump:
+            return cls(parse_config(dump))
+
+
+    @classmethod
+    def from_camera(cls, gp, cache_dir=DEFAULT_CACHE_DIR):
+        """ Get the config of the attached camera, using a gphoto2 command
+        (e.g. sh.gphoto2).
+
+        Model and firmware are queried to look up the cache, only on a miss
+        is the full config tree read. On a hit the current customfuncex value
+        is read once, as other custom functions may have been changed since.
+        """
+
+        model = cls._get_current(gp, MODEL_PATH)
+        firmware = cls._get_current(gp, FIRMWARE_PATH)
+        cache_name = re.sub(r"[^\w.-]+", "_", "{0}_{1}".format(model, firmware)) + ".json"
+        cache_file = os.path.join(cache_dir, cache_name)
+
+        if os.path.isfile(cache_file):
+            with open(cache_file) as cache:
+                cached = json.load(cache, object_pairs_hook=OrderedDict)
+            af_layout = cached["af_microadjustment"]
+            if af_layout is not None:
+                af_layout = tuple(af_layout)
+            config = cls(cached["config"], af_layout, cache_file)
+            if config.has_customfuncex():
+                config.set_customfuncex(cls._get_current(gp, CUSTOMFUNCEX_PATH))
+            return config
+
+        config = cls(parse_config(gp("--list-all-config", _err='gp_error.log')),
+                     cache_file=cache_file)
+        config.save()
+
+        return config
+
+
+    @staticmethod
+    def _get_current(gp, path):
+        """ Query the current value of a single config entry. """
+
+        for line in gp("--get-config={0}".format(path), _err='gp_error.log'):
+            if re.match(r"Current:", line, re.IGNORECASE):
+                return line.split(":", 1)[1].strip()
+        return ""
+
+
+    def save(self):
+        """ Write config tree and learned layout to the cache (if we have one). """
+
+        if self._cache_file is None:
+            return
+
+        cache_dir = os.path.dirname(self._cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self._cache_file, "w") as cache:
+            json.dump({"config": self._config, "af_microadjustment": self._af_layout},
+                      cache, indent=1)
+
+
+    def get(self, path, field="current"):
+        """ Return a field of a config entry (None if unknown). """
+
+        return self._config.get(path, {}).get(field)
+
+
+    def has_customfuncex(self):
+        """ Whether the camera offers the customfuncex entry at all. """
+
+        return CUSTOMFUNCEX_PATH in self._config
+
+
+    def set_customfuncex(self, customfuncex):
+        """ Take a new current customfuncex value and locate the AF
+        microadjustment within it.
+        """
+
+        self._customfuncex = customfuncex.strip().split(",")
+        self._af_index = None
+
+        layout = self._af_layout
+        if layout is None:
+            layout = AF_MICROADJUSTMENT_LAYOUTS.get(self.get(MODEL_PATH))
+        if layout is None:
+            # We don't guess, the layout must be confirmed or learned
+            return
+        try:
+            self._af_index = locate_customfuncex_value(customfuncex, *layout)
+        except ValueError:
+            self._af_index = None
+
+
+    def learn_af_microadjustment(self, before, after, value_before, value_after):
+        """ Learn where the AF microadjustment lives from the customfuncex
+        values read before and after the user changed (only) the AF
+        microadjustment from value_before to value_after.
+
+        Raises ValueError if that cannot be told from the two values.
+        Otherwise the layout is kept (and cached, see save()) and after is
+        taken as the current value.
+        """
+
+        self._af_layout = find_changed_value(before, after, value_before, value_after)
+        self.set_customfuncex(after)
+
+
+    def customfuncex(self):
+        """ Return the current customfuncex value. """
+
+        return ",".join(self._customfuncex)
+
+
+    def read_customfuncex(self, gp):
+        """ Ask the camera for its current customfuncex value. """
+
+        return self._get_current(gp, CUSTOMFUNCEX_PATH)
+
+
+    def matches_customfuncex(self, customfuncex):
+        """ Whether the given customfuncex value equals ours. """
+
+        return same_customfuncex(customfuncex, self.customfuncex())
+
+
+    def can_set_af_microadjustment(self):
+        """ Whether we found the AF microadjustment within customfuncex. """
+
+        return self._af_index is not None
+
+
+    def af_microadjustment_customfuncex(self, value):
+        """ Return the customfuncex value with the AF microadjustment set to
+        the given value.
+
+        The patched value is kept as the current one, assuming it gets
+        written to the camera.
+        """
+
+        self._customfuncex[self._af_index] = hex_value(value)
+        customfuncex = ",".join(self._customfuncex)
+        self._config[CUSTOMFUNCEX_PATH]["current"] = customfuncex
+
+        return customfuncex
@@ -21,6 +21,12 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 # Have new print 'statements' (Python 3.0)
 from __future__ import print_function
+# to fiddle with file paths
+import os
+# Use regex to pick adjustment values from filenames
+import re
+# to time the scoring
+import time
 # Some maths bits and bobs we require...
 import numpy as np
 # ...and plotting data and images
@@ -29,6 +35,9 @@ import matplotlib as mpl
 
 from calmadju.gphoto_helper import Gphoto
 from calmadju.image_helper import Image
+from calmadju.prescreen_helper import Prescreen
+from calmadju.results_helper import Results
+from calmadju.service_helper import RemoteScorer
 
 # Turn off toolbar for matplotlib windows
 mpl.rcParams["toolbar"] = "None"
@@ -39,6 +48,9 @@ This will try to calibrate your autofocus (AF) micro-adjustments (MADJ)
 
 """
 
+# Test shots are named AFtest_iter_<run>_adj_<value>.jpg
+_ADJUSTMENT_PATTERN = re.compile(r"AFtest_iter_\d+_adj_(-?\d+)\.jpg$")
+
 
 class Core(object):
     """ Core components of CalMAdju that controls camera usage and evaluates
@@ -51,25 +63,41 @@ class Core(object):
     # Fraction of 'frequency range' (kind of, but not really) for FFT sharpness
     _FRACTION = 0.3
     VARIANCE, GRADIENT, FFT = range(3)
+    # Slices of the FFT region per image size, see fft_region()
+    _fft_regions = {}
 
 
     def __init__(self, base_dir="images", batch_mode=False,
                  metrics=[VARIANCE, FFT],
-                 gp_cameraless_mode=True, gp_camerasafe_mode=True):
+                 gp_cameraless_mode=True, gp_camerasafe_mode=True,
+                 results_dir="results", camera=None, lens=None, focal_length=None,
+                 scoring_url=None, prescreen=True, max_retakes=1, window=None):
         # Base directory for images taken/assessed
         self._base_dir = base_dir
         # Default filename for reference image
         self.reference_image_filename = "reference.jpg"
         # Filename for currently taken and estimated image
         self.current_image_filename = ""
-        # Start with a default extent
-        self._x_window = 900
-        self._y_window = 600
+        # Start with a default extent (unless we're given one)
+        if window is None:
+            self._x_window = 900
+            self._y_window = 600
+        else:
+            self._x_window, self._y_window = window
+        self._window_given = window is not None
         # Do we run in batch mode and don't ask the user to interact
         self._batch = batch_mode
         # Lists for adjustments and sharpness estimates
         self._adjustment = []
         self._sharpness = []
+        # Raw per-metric scores for each adjustment
+        self._scores = []
+        # Adjustments of frames rejected by the pre-screening, and those left
+        # without any usable frame
+        self._rejected = []
+        self._skipped = []
+        # Parameters of the last fit (None if there was none)
+        self._fit_params = None
         # List of selected sharpness metrics
         self._selected = metrics
         ## Value of best estimate for the microadjustment
@@ -78,6 +106,29 @@ class Core(object):
         self._gphoto = Gphoto(base_dir=self._base_dir, batch_mode=self._batch,
                               cameraless_mode=gp_cameraless_mode,
                               camerasafe_mode=gp_camerasafe_mode)
+        # ...a client for the scoring service, if we use one...
+        if scoring_url is None:
+            self._scorer = None
+        else:
+            self._scorer = RemoteScorer(scoring_url)
+        # ...something to reject bad frames early, unless the service scores...
+        if prescreen and scoring_url is None:
+            self._prescreen = Prescreen()
+        else:
+            self._prescreen = None
+            if prescreen:
+                print("Pre-screening is disabled while using the scoring service, frames "
+                      "will neither be rejected nor retaken")
+        # ...(how often to retake rejected frames, if we have a camera)...
+        self._cameraless = gp_cameraless_mode
+        self._max_retakes = max_retakes
+        # ...and one to keep the results
+        self._results = Results(results_dir)
+        # Camera, lens, and focal length for the record, unless given we ask
+        # the camera
+        self._camera = camera
+        self._lens = lens
+        self._focal_length = focal_length
 
 
     @staticmethod
@@ -90,47 +141,249 @@ class Core(object):
     def estimate_sharpness(self):
         """ Estimate sharpness of the image by looking at a contrast value
         and image gradients.
+
+        Returns None if the image was rejected by the pre-screening.
         """
 
-        # List our score values
-        score = [0.0, 0.0, 0.0]
+        return self.score_file(self.current_image_filename)
 
-        # Read file
-        image = Image(self._base_dir, self.current_image_filename)
-        image.crop(self._x_window, self._y_window)
 
-        # Compute a variance measure that should prefer a contrasty result,
-        # thus a sharper one
-        score[self.VARIANCE] = np.mean(np.var(image.cropped_img))
-
-        # Compute gradients in x and y that should prefer more edges,
-        # so a sharper image
-        grad_y, grad_x = np.gradient(image.cropped_img, 2)
-        gnorm = np.sqrt(grad_x**2 + grad_y**2)
-        # Normalise to max value, in the hope of compensating lighting variations?
-        gnorm = gnorm / np.max(gnorm)
-        score[self.GRADIENT] = np.mean(gnorm)
-
-        # compute fft measure
-        fft = np.fft.fft2(image.cropped_img)  # It may be better to compute FFT on larger
-                                            # section (to get more frequencies...)
-        # Look at real part, normalise, and shift zeroth component to center
-        fft_usable = np.abs(np.real(np.fft.fftshift(fft)))
-        fft_usable /= np.max(fft_usable)
-
-        # Find center of frequencies and the extent
-        center_x = np.shape(fft)[0] / 2
-        center_y = np.shape(fft)[1] / 2
-        region_x_min = np.int(center_x - self._FRACTION*center_x)
-        region_x_max = np.int(center_x + self._FRACTION*center_x)
-        region_y_min = np.int(center_y - self._FRACTION*center_y)
-        region_y_max = np.int(center_y + self._FRACTION*center_y)
-        # Take region from center outwards, a fraction of frequencies
-        score[self.FFT] = np.sum(np.sqrt(fft_usable[region_x_min:region_x_max,
-                                                    region_y_min:region_y_max]))
+    def score_file(self, filename):
+        """ Load, crop, and score a single image from the base directory.
+
+        Uses the scoring service if we were given one. Otherwise a coarse
+        version of the crop is checked first, returns None if it is rejected.
+        """
+
+        if self._scorer is not None:
+            try:
+                return self._scorer.estimate_sharpness(
+                    os.path.abspath(os.path.join(self._base_dir, filename)),
+                    self._x_window, self._y_window)
+            except (IOError, ValueError) as error:
+                print("\nScoring service failed on the last image ({0}).\nExiting\n".
+                      format(error))
+                exit(1)
+
+        # Read file, keeping only the cropped region
+        image = Image(self._base_dir, filename)
+        image.crop(self._x_window, self._y_window, release=True)
+
+        if self._prescreen is not None:
+            accepted, reason = self._prescreen.check(image)
+            if not accepted:
+                print("Rejected {0} ({1})".format(filename, reason))
+                image.release()
+                return None
+
+        start = time.time()
+        score = self.score_crop(image.cropped_img)
+        if self._prescreen is not None:
+            self._prescreen.add_full_time(time.time() - start)
+        image.release()
+
         return score
 
 
+    @classmethod
+    def score_crop(cls, cropped_img):
+        """ Compute all sharpness metrics for an already cropped image.
+
+        Returns a list of scores indexed by VARIANCE, GRADIENT, and FFT.
+        """
+
+        return cls.score_crops([cropped_img])[0]
+
+
+    @classmethod
+    def score_crops(cls, crops):
+        """ Compute all sharpness metrics for a batch of cropped images.
+
+        Crops of the same size are stacked and scored in one go. Returns a list
+        with one list of scores (indexed by VARIANCE, GRADIENT, and FFT) per crop.
+        """
+
+        scores = [None] * len(crops)
+
+        # Group crops by their size
+        groups = {}
+        for i, crop in enumerate(crops):
+            groups.setdefault(np.shape(crop), []).append(i)
+
+        for shape, members in groups.items():
+            if len(members) == 1:
+                # No need to copy a single crop
+                stack = np.asarray(crops[members[0]])[np.newaxis]
+            else:
+                stack = np.array([crops[i] for i in members])
+
+            # Compute a variance measure that should prefer a contrasty result,
+            # thus a sharper one
+            variance = np.var(stack.reshape(len(members), -1), axis=1)
+
+            # Compute gradients in x and y that should prefer more edges,
+            # so a sharper image (single precision is plenty and halves the
+            # temporary buffers)
+            grad_y, grad_x = np.gradient(stack.astype(np.float32), 2, axis=(1, 2))
+            gnorm = np.sqrt(grad_x**2 + grad_y**2)
+            del grad_x, grad_y
+            # Normalise to max value, in the hope of compensating lighting variations?
+            gnorm /= np.max(gnorm, axis=(1, 2), keepdims=True)
+            gradient = np.mean(gnorm, axis=(1, 2))
+            del gnorm
+
+            # compute fft measure
+            fft = np.fft.fft2(stack)  # It may be better to compute FFT on larger
+                                      # section (to get more frequencies...)
+            # Look at real part, normalise, and shift zeroth component to center
+            fft_usable = np.abs(np.real(np.fft.fftshift(fft, axes=(1, 2))))
+            del fft
+            fft_usable /= np.max(fft_usable, axis=(1, 2), keepdims=True)
+
+            # Take region from center outwards, a fraction of frequencies
+            region_x, region_y = cls.fft_region(shape)
+            fft_score = np.sum(np.sqrt(fft_usable[:, region_x, region_y]), axis=(1, 2))
+            del fft_usable
+
+            for n, i in enumerate(members):
+                score = [0.0, 0.0, 0.0]
+                score[cls.VARIANCE] = variance[n]
+                score[cls.GRADIENT] = gradient[n]
+                score[cls.FFT] = fft_score[n]
+                scores[i] = score
+
+        return scores
+
+
+    @classmethod
+    def fft_region(cls, shape):
+        """ Return the slices of the central frequency region used for the FFT
+        metric, computed once per image size.
+        """
+
+        shape = tuple(shape[:2])
+        if shape not in cls._fft_regions:
+            # Find center of frequencies and the extent
+            center_x = shape[0] // 2
+            center_y = shape[1] // 2
+            region_x_min = int(center_x - cls._FRACTION*center_x)
+            region_x_max = int(center_x + cls._FRACTION*center_x)
+            region_y_min = int(center_y - cls._FRACTION*center_y)
+            region_y_max = int(center_y + cls._FRACTION*center_y)
+            cls._fft_regions[shape] = (slice(region_x_min, region_x_max),
+                                       slice(region_y_min, region_y_max))
+
+        return cls._fft_regions[shape]
+
+
+    def iter_image_files(self):
+        """ Generator over all test shots found in the base directory.
+
+        Yields tuples of filename and adjustment value, as encoded in the
+        filename. The reference image (or anything else) is skipped.
+        """
+
+        for filename in sorted(os.listdir(self._base_dir)):
+            match = _ADJUSTMENT_PATTERN.match(filename)
+            if match:
+                yield filename, int(match.group(1))
+
+
+    def stream_sharpness(self, files, results_filename="sharpness.csv"):
+        """ Generator streaming images through decode, crop, and score.
+
+        Takes an iterable of (filename, adjustment) tuples, e.g. from
+        iter_image_files(). Only one image is held in memory at any time and
+        each result is appended to the results file (in the results directory)
+        as soon as it is known. Yields tuples of filename, adjustment, and
+        the list of scores (None for frames rejected by the pre-screening).
+        """
+
+        results_path = self._results.file_path(results_filename)
+        with open(results_path, "w") as results:
+            results.write("filename,adjustment,variance,gradient,fft,status\n")
+            for filename, value in files:
+                # Only the numbers survive, the crop is dropped right away
+                score = self.score_file(filename)
+
+                if score is None:
+                    results.write("{f},{v},,,,rejected\n".format(f=filename, v=value))
+                else:
+                    results.write("{f},{v},{s[0]:.8g},{s[1]:.8g},{s[2]:.8g},ok\n".
+                                  format(f=filename, v=value, s=score))
+                results.flush()
+
+                yield filename, value, score
+
+
+    def stream_main(self):
+        """ Analyse previously taken images with bounded memory usage.
+
+        Rather than keeping every score around, we only keep running sums per
+        adjustment value. Their number is limited by what the camera offers,
+        not by the number of images.
+        """
+
+        self.greeting()
+
+        # Let the user pick the window on the reference image, if there is one
+        # and we weren't told already
+        if not self._window_given and not self._batch and \
+           os.path.isfile(os.path.join(self._base_dir, self.reference_image_filename)):
+            self.find_center()
+
+        print("Using a window of {0} by {1} pixels around the center".
+              format(2 * self._x_window, 2 * self._y_window))
+
+        norm = None
+        sums = {}
+        score_sums = {}
+        counts = {}
+        n_images = 0
+        n_rejected = 0
+        for filename, value, sharpness in self.stream_sharpness(self.iter_image_files()):
+            if sharpness is None:
+                self._rejected.append(value)
+                n_rejected = n_rejected + 1
+                continue
+            if norm is None:
+                norm = sharpness
+
+            combined_sharpness = [sharpness[i] / norm[i] for i in self._selected]
+            sums[value] = sums.get(value, 0.) + np.mean(combined_sharpness)
+            score_sums[value] = np.add(score_sums.get(value, 0.), sharpness)
+            counts[value] = counts.get(value, 0) + 1
+            n_images = n_images + 1
+
+        if n_images == 0:
+            if n_rejected == 0:
+                print("No test shots found in {0}".format(self._base_dir))
+            else:
+                print("All {0} test shots in {1} were rejected".format(n_rejected,
+                                                                     self._base_dir))
+                self._prescreen.summary()
+            return
+
+        print("Processed {0} images for {1} adjustment values".format(n_images, len(sums)))
+        self._skipped = sorted(set(value for value in self._rejected if value not in sums))
+        if self._prescreen is not None:
+            self._prescreen.summary()
+            self.rejection_summary()
+
+        # Averages per adjustment are all we need for the fit
+        self._adjustment = sorted(sums)
+        self._sharpness = [sums[value] / counts[value] for value in self._adjustment]
+        self._scores = [score_sums[value] / counts[value] for value in self._adjustment]
+
+        plt.ion()
+        self.record_sweep(self.find_best_madj())
+
+        self.wait_key(override=True)
+
+        plt.show()
+        plt.close()
+
+
     def find_center(self):
         """ Display image w/ matplotlib and have the user restrict the interesting
         area.
@@ -215,16 +468,48 @@ class Core(object):
         plt.draw()
 
 
-    def find_best_madj(self):
-        """ Find best value by fitting a Gaussian. """
+    @staticmethod
+    def fit_function(x_var, amplitude, shift, width):
+        """Fit function."""
+        return amplitude * np.exp(-1/width * (x_var - shift)**2)
+
+
+    @classmethod
+    def fit_gaussian(cls, adjustment, sharpness):
+        """ Fit a Gaussian to sharpness values over adjustments.
+
+        Returns the parameters amplitude, shift, and width. Raises ValueError
+        or RuntimeError (as scipy does) if the fit is not possible.
+        """
+
+        if len(adjustment) < 3:
+            raise ValueError("Need at least 3 points to fit a Gaussian, got {0}".
+                             format(len(adjustment)))
 
         import scipy
         from scipy.optimize import curve_fit
         from pkg_resources import parse_version
 
-        def fit_function(x_var, amplitude, shift, width):
-            """Fit function."""
-            return amplitude * np.exp(-1/width * (x_var - shift)**2)
+        data = np.array([adjustment, sharpness])
+        maxval = np.max(data[1, :])
+
+        if parse_version(scipy.version.version) == parse_version("0.18.0"):
+            # yet to be tested
+            return curve_fit(cls.fit_function,
+                             data[0, :], data[1, :],
+                             p0=[maxval, 0, 1],
+                             bounds=([0, np.min(data[0, :]), 1e-6],
+                                     [2*maxval, np.max(data[0, :]), 1.]))[0]
+
+        return curve_fit(cls.fit_function,
+                         data[0, :], data[1, :],
+                         p0=[maxval, 0, 1])[0]
+
+
+    def find_best_madj(self):
+        """ Find best value by fitting a Gaussian. """
+
+        fit_function = self.fit_function
 
         print("Trying to fit the measured points w/ a Gaussian to determine best "
               "'region'\n")
@@ -235,29 +520,29 @@ class Core(object):
         maxval = np.max(data[1, :])
 
         try:
-            if parse_version(scipy.version.version) == parse_version("0.18.0"):
-                # yet to be tested
-                popt = curve_fit(fit_function,
-                                 data[0, :], data[1, :],
-                                 p0=[maxval, 0, 1],
-                                 bounds=([0, np.min(data[0, :]), 1e-6],
-                                         [2*maxval, np.max(data[0, :]), 1.]))[0]
-            else:
-                popt = curve_fit(fit_function,
-                                 data[0, :], data[1, :],
-                                 p0=[maxval, 0, 1])[0]
+            popt = None
+            if self._scorer is not None:
+                try:
+                    popt = self._scorer.fit_gaussian(self._adjustment, self._sharpness)
+                except IOError as error:
+                    print("Scoring service failed ({0}), fitting locally".format(error))
+            if popt is None:
+                popt = self.fit_gaussian(self._adjustment, self._sharpness)
         except ValueError:
             print("Something went wrong with the measured values, fit not possible")
+            self._fit_params = None
             return 0
         except RuntimeError:
             print("The fit did not converge.\n\nAre the images usable? Does the sharpness"
                   "estimate indicate no real change in sharpness? In any case,"
                   "the fit is not possible")
+            self._fit_params = None
             return 0
         #except OptimizeWarning:
         #    print("The fit did not return proper covariance values, so results may"
         #          "be fishy. Check the plot")
 
+        self._fit_params = popt
         print("Parameters to the Gaussian function are: {0}".format(popt))
         print("The best microadjustment could thus be around {0}".
               format(int(popt[1])))
@@ -277,6 +562,44 @@ class Core(object):
         return int(popt[1])
 
 
+    def rejection_summary(self):
+        """ Print which adjustments had frames rejected and which are missing
+        from the fit.
+        """
+
+        if self._rejected:
+            print("Rejected frames for adjustments: {0}".
+                  format(", ".join(str(value) for value in self._rejected)))
+        if self._skipped:
+            print("No usable frame (missing from the fit) for adjustments: {0}".
+                  format(", ".join(str(value) for value in self._skipped)))
+
+
+    def record_sweep(self, optimum):
+        """ Write the adjustments, scores, and fit of the current sweep to the
+        results store.
+        """
+
+        camera = self._camera
+        if camera is None:
+            camera = self._gphoto.camera_model()
+        lens = self._lens
+        if lens is None:
+            lens = self._gphoto.lens_name()
+        focal_length = self._focal_length
+        if focal_length is None:
+            focal_length = np.nan
+
+        if self._fit_params is None:
+            optimum = np.nan
+
+        sweep = self._results.write_sweep(camera, lens, focal_length,
+                                          self._adjustment, self._scores,
+                                          self._fit_params, optimum,
+                                          rejected=self._rejected, skipped=self._skipped)
+        print("Results written to {0}".format(sweep))
+
+
     def wait_key(self, print_msg="Press return to continue\n", override=False):
         '''Wait for a key press on the console.
 
@@ -316,8 +639,8 @@ class Core(object):
         # Now loop over a couple of values and evaluate image sharpness,
         # start with 0 to have a default image first
         # NOTE: we want to allow for several 'runs' to revisit some values around the
-        # approximate ideal point more often, this is a TODO atm
-        run = 0
+        # approximate ideal point more often, this is a TODO atm. For now, later
+        # runs only retake frames rejected by the pre-screening.
         plt.ion()
         self.display_reference()
 
@@ -326,11 +649,24 @@ class Core(object):
               "\n                     |        |        FFT   "
               "\n                     \\        \\        \\     ")
         # TODO: make values user-selectable
-        for value in [-20, -15, -12, -10, -8, -6, -4, -2, 0, 2, 4, 6, 8, 10, 12, 15, 20]:
+        pending = [(0, value) for value in
+                   [-20, -15, -12, -10, -8, -6, -4, -2, 0, 2, 4, 6, 8, 10, 12, 15, 20]]
+        while pending:
+            run, value = pending.pop(0)
             self._gphoto.set_af_microadjustment(value)
             self.current_image_filename = "AFtest_iter_{r}_adj_{v}.jpg".format(r=run, v=value)
             self._gphoto.get_image(self.current_image_filename)
             sharpness = self.estimate_sharpness()
+            if sharpness is None:
+                self._rejected.append(value)
+                # Without a camera there is nothing to retake
+                if not self._cameraless and run < self._max_retakes:
+                    print("Adjustment {0:3d} scheduled for a retake".format(value))
+                    pending.append((run + 1, value))
+                else:
+                    print("Adjustment {0:3d} skipped".format(value))
+                    self._skipped.append(value)
+                continue
             try:
                 norm
             except NameError:
@@ -344,6 +680,7 @@ class Core(object):
             # normalised values
             self._adjustment.append(value)
             self._sharpness.append(np.mean(combined_sharpness))
+            self._scores.append(sharpness)
 
             # At a later stage, we should really fit both (or also the FFT one)
             # independently and compare the results...
@@ -351,10 +688,14 @@ class Core(object):
             print("Sharpness estimators {s[0]:.4f} / {s[1]:.4f} / {s[2]:.4f} for adjustment {v:3d}".\
                   format(s=all_sharpnesses, v=value))
 
+        if self._prescreen is not None:
+            self._prescreen.summary()
+            self.rejection_summary()
+
         self.wait_key()
 
         # Fit and find max
-        self.find_best_madj()
+        self.record_sweep(self.find_best_madj())
 
         self.wait_key(override=True)
 
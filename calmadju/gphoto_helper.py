@@ -26,12 +26,14 @@ import re
 # to fiddle with file paths
 import os
 
-# Check if we find the gphoto2 cdl utility
+from calmadju.config_helper import CameraConfig, DEFAULT_CACHE_DIR, same_customfuncex
+
+# Check if we find the gphoto2 cdl utility (we only insist on it once we
+# really talk to a camera, see check_version)
 try:
     from sh import gphoto2 as gp
 except ImportError:
-    print("\ngphoto2 not found\n")
-    exit(1)
+    gp = None
 
 # Set up custom parameter strings for known cameras
 # NOTE: currently only a Canon EOS 7D is known
@@ -41,6 +43,9 @@ CUSTOMFUNCEX['Canon EOS 7D'] = \
 'VALUE,' \
 '2,0,512,2,0,17,513,1,1,510,1,0,514,1,0,515,1,0,50e,1,0,516,1,1,60f,1,0,'
 
+# AF microadjustments the user sets when we look for the setting
+DISCOVERY_VALUES = (0, 5)
+
 CAMERA_BANNER = """
 +------------------------------------------------------------------+
 | NOW YOU NEED TO SET UP YOUR CAMERA                               |
@@ -65,7 +70,8 @@ class Gphoto(object):
     """
 
 
-    def __init__(self, base_dir, batch_mode, cameraless_mode, camerasafe_mode):
+    def __init__(self, base_dir, batch_mode, cameraless_mode, camerasafe_mode,
+                 config_cache_dir=DEFAULT_CACHE_DIR):
         # Base directory for images taken/assessed
         self._base_dir = base_dir
         # Do we run in batch mode and don't ask the user to interact
@@ -78,6 +84,14 @@ class Gphoto(object):
         self._auto_cam = False
         self._cameras = []
         self._n_cameras_found = 0
+        # Camera config (and where to cache it)
+        self._config = None
+        self._config_cache_dir = config_cache_dir
+        # Did we check the camera took our first customfuncex write?
+        self._config_verified = False
+        # customfuncex value at the start of the session, to restore it if
+        # the camera does not take our changes
+        self._original_customfuncex = None
 
         if self._manual:
             # This line will force the AF auto-set to always fail
@@ -90,6 +104,10 @@ class Gphoto(object):
         if self._dry:
             return
 
+        if gp is None:
+            print("\ngphoto2 not found\n")
+            exit(1)
+
         # Enquire gphoto2 version
         try:
             gp_version = gp("--version", _err='gp_error.log')
@@ -133,7 +151,9 @@ class Gphoto(object):
             # Why is there a 'Loading sth usb something' message...?
             if not re.match(r"(Loadin|Model|(-)+)", line, re.IGNORECASE):
                 self._n_cameras_found = self._n_cameras_found + 1
-                self._cameras.append(line.split()[0])
+                # Model and port are separated by a bunch of spaces, the model
+                # name itself may contain single ones
+                self._cameras.append(re.split(r"\s{2,}", line.strip())[0])
 
         # Do we _have_ a camera?
         if self._n_cameras_found < 1:
@@ -148,9 +168,26 @@ class Gphoto(object):
                 print("\nPlease attach only one camera!\n")
                 exit(1)
 
-        # Do we know the camera's custom function string?
-        # AND, do we want to change them automagically?
-        if self._cameras[0] in CUSTOMFUNCEX and self._auto_cam:
+        # Do we want to change settings automagically?
+        # AND, can we find the AF microadjustment in the camera's config?
+        if not self._manual:
+            try:
+                self._config = CameraConfig.from_camera(gp, self._config_cache_dir)
+            except:
+                print("Cannot read the camera's config")
+                self._config = None
+
+        # Never seen this camera's layout? Learn it (needs the user though)
+        if self._config is not None and self._config.has_customfuncex() and \
+           not self._config.can_set_af_microadjustment():
+            self.discover_af_microadjustment()
+
+        if self._config is not None and self._config.can_set_af_microadjustment():
+            self._original_customfuncex = self._config.customfuncex()
+            print("Found the AF microadjustment in the custom functions ex setting\n")
+            self._auto_cam = True
+        # OR, do we know the camera's custom function string?
+        elif self.camera_model() in CUSTOMFUNCEX and not self._manual:
             print("We match settings for the custom functions ex call\n")
             self._auto_cam = True
         else:
@@ -159,6 +196,60 @@ class Gphoto(object):
             self._auto_cam = False
 
 
+    def discover_af_microadjustment(self):
+        ''' Find the AF microadjustment within customfuncex by having the user
+        change it on the camera (once per camera and firmware, the result is
+        cached).
+
+        This is the procedure described in
+        doc/How_to_find_the_custom_AF_adjustment_setting_with_gphoto2.md
+        '''
+        if self._batch:
+            print("The AF microadjustment of this camera is not known yet, run once "
+                  "without batch mode to find it\n")
+            return
+
+        print("The AF microadjustment of this camera is not known yet, let's find it.")
+        print("Change nothing but the AF microadjustment on the camera.\n")
+        self.wait_key("Please set the AF microadjustment to {0} on the camera and press "
+                      "return".format(DISCOVERY_VALUES[0]), override=True)
+        before = self._config.read_customfuncex(gp)
+        self.wait_key("Please set the AF microadjustment to {0} on the camera and press "
+                      "return".format(DISCOVERY_VALUES[1]), override=True)
+        after = self._config.read_customfuncex(gp)
+
+        try:
+            self._config.learn_af_microadjustment(before, after, *DISCOVERY_VALUES)
+        except ValueError as error:
+            print("Could not find the AF microadjustment ({0})\n".format(error))
+            return
+        self._config.save()
+
+
+    def camera_model(self):
+        ''' Return the model of the detected camera (or 'unknown'). '''
+        cameras = [cam for cam in self._cameras if cam != "Test mode"]
+        if cameras:
+            return cameras[0]
+        return "unknown"
+
+
+    def lens_name(self):
+        ''' Ask the camera for the name of the attached lens (or 'unknown'). '''
+        if self._dry:
+            return "unknown"
+
+        try:
+            gp_lens = gp("--get-config=lensname", _err='gp_error.log')
+        except:
+            return "unknown"
+
+        for line in gp_lens:
+            if re.match(r"Current:", line, re.IGNORECASE):
+                return line.split(":", 1)[1].strip()
+        return "unknown"
+
+
     def prepare_camera(self):
         ''' Advise the user on how to set up the camera. '''
         if self._dry:
@@ -177,21 +268,61 @@ class Gphoto(object):
 
         if self._auto_cam:
             # Change the adjustment value ourselves
-            pre, post = CUSTOMFUNCEX[self._cameras[0]].split('VALUE')[:2]
-            if value >= 0:
-                hexvalue = "%02x" % value
+            use_config = self._config is not None and \
+                         self._config.can_set_af_microadjustment()
+            if use_config:
+                # Patch the current setting, no need to ask the camera again
+                customfuncex = self._config.af_microadjustment_customfuncex(value)
             else:
-                hexvalue = "%02x" % (256 + value)
-
-            command = ["--set-config=customfuncex={0}{1}{2}".format(pre, hexvalue,
-                                                                    post)]
-            gp(command, _out='gp_output.log', _err='gp_error.log')
+                pre, post = CUSTOMFUNCEX[self.camera_model()].split('VALUE')[:2]
+                if value >= 0:
+                    hexvalue = "%02x" % value
+                else:
+                    hexvalue = "%02x" % (256 + value)
+                customfuncex = "{0}{1}{2}".format(pre, hexvalue, post)
+
+            command = ["--set-config=customfuncex={0}".format(customfuncex)]
+            try:
+                gp(command, _out='gp_output.log', _err='gp_error.log')
+            except:
+                # Let the read back below sort it out
+                pass
+
+            # Read the setting back once, to be sure the layout is right
+            if use_config and not self._config_verified:
+                if self._config.matches_customfuncex(self._config.read_customfuncex(gp)):
+                    self._config_verified = True
+                else:
+                    print("The camera did not take the new setting, you will have to "
+                          "adjust the settings manually\n")
+                    self.restore_customfuncex()
+                    self._config = None
+                    self._auto_cam = False
+                    self.set_af_microadjustment(value)
         else:
             print("Please change the microadjustment level to {0} and press "
                   "return when ready".format(value))
             self.wait_key("")
 
 
+    def restore_customfuncex(self):
+        ''' Write back the customfuncex value from the start of the session
+        and check the camera took it.
+        '''
+        command = ["--set-config=customfuncex={0}".format(self._original_customfuncex)]
+        try:
+            gp(command, _out='gp_output.log', _err='gp_error.log')
+        except:
+            pass
+
+        if same_customfuncex(self._config.read_customfuncex(gp), self._original_customfuncex):
+            print("Restored the previous custom functions\n")
+        else:
+            print("WARNING: could not restore the previous custom functions, please "
+                  "check them on the camera!\n")
+            print("They were: {0}\n".format(self._original_customfuncex))
+
+
     def get_image(self, filename):
         ''' Capture an image and download said image. '''
         if self._dry:
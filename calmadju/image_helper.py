@@ -54,7 +54,20 @@ class Image(object):
 
 
     def load(self, base_dir, filename):
-        """ Try loading the given file.
+        """ Try loading the given file, exit if that fails.
+
+        Requires base directory and filename to load image data from.
+        """
+
+        try:
+            self.read(base_dir, filename)
+        except IOError:
+            print("\nFailed reading the last image.\nExiting\n")
+            exit(1)
+
+
+    def read(self, base_dir, filename):
+        """ Load the given file, raise IOError if that fails.
 
         Requires base directory and filename to load image data from.
         """
@@ -68,20 +81,52 @@ class Image(object):
         # https://stackoverflow.com/questions/12201577/how-can-i-convert-an-rgb-image-into-grayscale-in-python
 
         # Check if we really managed to load an image
-        if self.img == None:
-            print("\nFailed reading the last image.\nExiting\n")
-            exit(1)
+        if self.img is None:
+            raise IOError("Cannot read {0}".format(self.filename))
 
 
-    def crop(self, x_window, y_window):
+    def crop(self, x_window, y_window, release=False):
         """ Crop image to the given size.
 
         Takes 2 parameters: symmetric extent in x&y starting from center position.
+        The extent is limited to what fits into the image.
+        Set release to True to keep only a compact copy of the cropped region
+        and drop the full frame.
         """
 
+        if x_window <= 0 or y_window <= 0:
+            raise ValueError("Window must be positive, got {0} by {1}".format(x_window, y_window))
+
         height, width = self.img.shape[:2]
-        x_center = width / 2
-        y_center = height / 2
+        x_center = width // 2
+        y_center = height // 2
+        # Don't let the window wrap around the image borders
+        x_window = min(x_window, x_center)
+        y_window = min(y_window, y_center)
 
         self.cropped_img = self.img[y_center - y_window:y_center + y_window,
                                     x_center - x_window:x_center + x_window]
+
+        if release:
+            # The crop is only a view into the full frame, so copy it before
+            # letting go of the decoded image
+            self.cropped_img = self.cropped_img.copy()
+            self.img = None
+
+
+    def downsample(self, factor):
+        """ Return a reduced copy of the cropped image.
+
+        Takes the factor to shrink both dimensions by (averaging pixels).
+        """
+
+        height, width = self.cropped_img.shape[:2]
+        return cv2.resize(self.cropped_img, (max(width // factor, 1), max(height // factor, 1)),
+                          interpolation=cv2.INTER_AREA)
+
+
+    def release(self):
+        """ Drop all image data, e.g. once it has been scored. """
+
+        self.img = None
+        self.cropped_img = None
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+This file is part of CalMAdju.
+
+Copyright (C) 2016-2017 di-br@users.noreply.github.com
+                        https://github.com/di-br/CalMAdju
+
+CalMAdju is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Have new print 'statements' (Python 3.0)
+from __future__ import print_function
+# to keep track of the time spent
+import time
+from collections import deque
+# Some maths bits and bobs we require...
+import numpy as np
+
+
+class Prescreen(object):
+    """ Class to reject obviously bad frames (AF missed, light flickered)
+    before spending time on full resolution scoring.
+
+    Cheap metrics on a heavily downsampled crop are compared against the
+    frames of the sweep accepted so far.
+    """
+
+
+    def __init__(self, factor=8, threshold=5., min_frames=3, history=50,
+                 brightness_tolerance=0.1, sharpness_tolerance=0.5):
+        # Downsampling factor for the coarse crop
+        self.factor = factor
+        # How many (scaled) median absolute deviations make an outlier
+        self._threshold = threshold
+        # Frames to accept before we trust the statistics
+        self._min_frames = min_frames
+        # Relative deviations from the median we accept no matter what, the
+        # sharpness is meant to change over the sweep after all
+        self._brightness_tolerance = brightness_tolerance
+        self._sharpness_tolerance = sharpness_tolerance
+        # Coarse metrics of the most recently accepted frames
+        self._brightness = deque(maxlen=history)
+        self._sharpness = deque(maxlen=history)
+        # Bookkeeping for the summary
+        self._n_checked = 0
+        self._n_rejected = 0
+        self._coarse_time = 0.
+        self._full_time = 0.
+        self._n_full = 0
+
+
+    @staticmethod
+    def coarse_metrics(thumbnail):
+        """ Compute mean brightness and a simple gradient based sharpness of
+        a downsampled crop.
+        """
+
+        thumbnail = np.asarray(thumbnail, dtype=np.float32)
+        grad_y, grad_x = np.gradient(thumbnail)
+
+        return np.mean(thumbnail), np.mean(np.sqrt(grad_x**2 + grad_y**2))
+
+
+    def check(self, image):
+        """ Decide whether a frame (an Image with its crop set) is worth
+        scoring at full resolution.
+
+        Returns a tuple of a boolean (True if accepted) and a reason for the
+        rejection (None if accepted).
+        """
+
+        start = time.time()
+        brightness, sharpness = self.coarse_metrics(image.downsample(self.factor))
+        self._n_checked = self._n_checked + 1
+
+        reason = None
+        if len(self._brightness) >= self._min_frames:
+            if self._is_outlier(brightness, self._brightness, self._brightness_tolerance,
+                                both_sides=True):
+                reason = "exposure off"
+            elif self._is_outlier(sharpness, self._sharpness, self._sharpness_tolerance,
+                                  both_sides=False):
+                reason = "out of focus"
+
+        if reason is None:
+            self._brightness.append(brightness)
+            self._sharpness.append(sharpness)
+        else:
+            self._n_rejected = self._n_rejected + 1
+
+        self._coarse_time = self._coarse_time + time.time() - start
+
+        return reason is None, reason
+
+
+    def _is_outlier(self, value, accepted, tolerance, both_sides):
+        """ Compare a value to the median of the accepted ones.
+
+        An outlier must be off by more than threshold times the (scaled)
+        median absolute deviation AND by more than the relative tolerance.
+        """
+
+        median = np.median(accepted)
+        spread = 1.4826 * np.median(np.abs(np.array(accepted) - median))
+        deviation = value - median
+        if both_sides:
+            deviation = abs(deviation)
+        else:
+            # Only frames worse than the rest are suspicious
+            deviation = -deviation
+
+        return deviation > self._threshold * spread and deviation > tolerance * abs(median)
+
+
+    def add_full_time(self, seconds):
+        """ Account for the time a full resolution scoring took. """
+
+        self._full_time = self._full_time + seconds
+        self._n_full = self._n_full + 1
+
+
+    def summary(self):
+        """ Print rejection rate and the (estimated) time saved, including the
+        cost of downsampling.
+        """
+
+        if self._n_checked == 0:
+            return
+
+        if self._n_full > 0:
+            saved = self._n_rejected * self._full_time / self._n_full
+        else:
+            saved = 0.
+        print("Pre-screening rejected {r} of {n} frames ({p:.0f}%), saving about "
+              "{s:.2f}s of full resolution scoring for {c:.2f}s spent pre-screening".
+              format(r=self._n_rejected, n=self._n_checked,
+                     p=100. * self._n_rejected / self._n_checked,
+                     s=saved, c=self._coarse_time))
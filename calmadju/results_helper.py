@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+This file is part of CalMAdju.
+
+Copyright (C) 2016-2017 di-br@users.noreply.github.com
+                        https://github.com/di-br/CalMAdju
+
+CalMAdju is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Have new print 'statements' (Python 3.0)
+from __future__ import print_function
+# to check why a file could not be created
+import errno
+# to fiddle with file paths
+import os
+# to make the sweep names file system friendly
+import re
+# to replace the index in one go
+import tempfile
+# to time stamp the sweeps
+import time
+# Results are stored as (compressed) numpy arrays
+import numpy as np
+
+# Name of the file keeping one row per sweep
+INDEX_FILENAME = "index.npz"
+# Columns of the index, all of them 1d arrays of equal length
+INDEX_COLUMNS = ["timestamp", "camera", "lens", "focal_length", "optimum", "sweep"]
+# Lock file guarding updates of the index
+LOCK_FILENAME = "index.lock"
+# How long (in s) to wait for the lock before giving up
+LOCK_TIMEOUT = 30.
+
+# Atomically replace a file (os.rename won't overwrite on Windows)
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+
+class Results(object):
+    """ Class to store the results of a sweep in a compact columnar format and
+    to query them later on.
+
+    Every sweep goes into its own .npz file, a small index (also .npz) keeps
+    one row per sweep so questions across bodies and lenses can be answered
+    without loading any sweep, let alone any image.
+    """
+
+
+    def __init__(self, results_dir="results"):
+        # Directory for sweep records and the index
+        self._results_dir = results_dir
+
+
+    def write_sweep(self, camera, lens, focal_length, adjustment, scores,
+                    fit_params, optimum, timestamp=None, rejected=None, skipped=None):
+        """ Store the record of one sweep and add it to the index.
+
+        Takes the camera model, lens name, focal length (use NaN if unknown),
+        the list of adjustment values, a list of per-metric scores (one
+        VARIANCE/GRADIENT/FFT triple per adjustment), the fit parameters
+        (None if the fit failed), and the optimum found. Optionally takes the
+        adjustments of frames rejected by the pre-screening (one entry per
+        rejected frame) and those left without any usable frame.
+        Returns the filename of the sweep record.
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        if fit_params is None:
+            fit_params = [np.nan, np.nan, np.nan]
+        if rejected is None:
+            rejected = []
+        if skipped is None:
+            skipped = []
+
+        if not os.path.isdir(self._results_dir):
+            os.makedirs(self._results_dir)
+
+        # Name the record after camera and time, never overwrite an older one
+        stem = "sweep_{c}_{t}_{u:06d}".format(
+            c=re.sub(r"[^\w.-]+", "_", camera),
+            t=time.strftime("%Y%m%d_%H%M%S", time.localtime(timestamp)),
+            u=int((timestamp % 1) * 1e6))
+        sweep = stem + ".npz"
+        counter = 0
+        while True:
+            try:
+                handle = os.open(os.path.join(self._results_dir, sweep),
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+                counter = counter + 1
+                sweep = "{0}_{1}.npz".format(stem, counter)
+
+        with os.fdopen(handle, "wb") as record:
+            np.savez_compressed(record,
+                                timestamp=np.float64(timestamp),
+                                camera=np.array(camera),
+                                lens=np.array(lens),
+                                focal_length=np.float64(focal_length),
+                                adjustment=np.array(adjustment, dtype=np.int16),
+                                scores=np.array(scores, dtype=np.float32),
+                                fit_params=np.array(fit_params, dtype=np.float64),
+                                optimum=np.float64(optimum),
+                                rejected=np.array(rejected, dtype=np.int16),
+                                skipped=np.array(skipped, dtype=np.int16))
+
+        # Append a row to the index (it's small, so simply rewrite it). Other
+        # stations may share the directory, so hold a lock while doing so and
+        # replace the index in one go.
+        row = {"timestamp": timestamp, "camera": camera, "lens": lens,
+               "focal_length": focal_length, "optimum": optimum, "sweep": sweep}
+        self._lock_index()
+        try:
+            index = self.load_index()
+            columns = {}
+            for column in INDEX_COLUMNS:
+                columns[column] = np.append(index[column], row[column])
+            handle, temp_name = tempfile.mkstemp(suffix=".npz", dir=self._results_dir)
+            with os.fdopen(handle, "wb") as temp:
+                np.savez_compressed(temp, **columns)
+            _replace(temp_name, os.path.join(self._results_dir, INDEX_FILENAME))
+        finally:
+            self._unlock_index()
+
+        return sweep
+
+
+    def file_path(self, filename):
+        """ Return the path of a file in the results directory, creating the
+        directory if needed.
+        """
+
+        if not os.path.isdir(self._results_dir):
+            os.makedirs(self._results_dir)
+
+        return os.path.join(self._results_dir, filename)
+
+
+    def _lock_index(self):
+        """ Wait for and take the lock on the index. """
+
+        lock = os.path.join(self._results_dir, LOCK_FILENAME)
+        deadline = time.time() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            if time.time() > deadline:
+                raise IOError("Index is locked, remove {0} if no other sweep is "
+                              "being written".format(lock))
+            time.sleep(0.05)
+
+
+    def _unlock_index(self):
+        """ Release the lock on the index. """
+
+        os.remove(os.path.join(self._results_dir, LOCK_FILENAME))
+
+
+    def load_index(self):
+        """ Load the index, returns a dictionary of columns (empty if there is
+        no index yet).
+        """
+
+        filename = os.path.join(self._results_dir, INDEX_FILENAME)
+        if not os.path.isfile(filename):
+            return {"timestamp": np.array([], dtype=np.float64),
+                    "camera": np.array([], dtype=str),
+                    "lens": np.array([], dtype=str),
+                    "focal_length": np.array([], dtype=np.float64),
+                    "optimum": np.array([], dtype=np.float64),
+                    "sweep": np.array([], dtype=str)}
+
+        with np.load(filename, allow_pickle=False) as data:
+            return dict((column, data[column]) for column in INDEX_COLUMNS)
+
+
+    def load_sweep(self, sweep):
+        """ Load the full record of a single sweep as a dictionary. """
+
+        with np.load(os.path.join(self._results_dir, sweep), allow_pickle=False) as data:
+            return dict((key, data[key]) for key in data.files)
+
+
+    def query(self, camera=None, lens=None, focal_length=None):
+        """ Select rows of the index matching the given camera, lens, and focal
+        length (None matches everything).
+
+        Returns a dictionary of columns, sorted by time.
+        """
+
+        index = self.load_index()
+        selected = np.ones(len(index["timestamp"]), dtype=bool)
+        if camera is not None:
+            selected &= index["camera"] == camera
+        if lens is not None:
+            selected &= index["lens"] == lens
+        if focal_length is not None:
+            selected &= index["focal_length"] == focal_length
+
+        order = np.argsort(index["timestamp"][selected])
+        return dict((column, index[column][selected][order]) for column in INDEX_COLUMNS)
+
+
+    def print_drift(self, camera, lens=None):
+        """ Print how the optimum for a camera (and lens) developed over time. """
+
+        rows = self.query(camera=camera, lens=lens)
+        if len(rows["timestamp"]) == 0:
+            print("No sweeps recorded for {0}".format(camera))
+            return
+
+        print("Optimum for {0} over time:\n".format(camera))
+        previous = None
+        for i in range(len(rows["timestamp"])):
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(rows["timestamp"][i]))
+            optimum = rows["optimum"][i]
+            if previous is None or np.isnan(previous) or np.isnan(optimum):
+                drift = ""
+            else:
+                drift = "{0:+.0f}".format(optimum - previous)
+            print("{d}  {l:<30} {f:>6.0f}mm  optimum {o:4.0f} {r}".
+                  format(d=date, l=rows["lens"][i], f=rows["focal_length"][i],
+                         o=optimum, r=drift))
+            previous = optimum
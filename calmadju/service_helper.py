@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""
+This file is part of CalMAdju.
+
+Copyright (C) 2016-2017 di-br@users.noreply.github.com
+                        https://github.com/di-br/CalMAdju
+
+CalMAdju is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Have new print 'statements' (Python 3.0)
+from __future__ import print_function
+# Requests and replies are plain JSON
+import json
+# to check image files for changes
+import os
+# The server scores in a thread of its own
+import threading
+import time
+from collections import OrderedDict
+
+# Only use the standard library here, so clients need nothing else
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+    from queue import Queue, Empty
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen, HTTPError
+    from Queue import Queue, Empty
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+class RemoteScorer(object):
+    """ Client for a running scoring service.
+
+    Offers the same scoring and fitting Core does locally, but lets the
+    service do the work.
+    """
+
+
+    def __init__(self, url=DEFAULT_URL):
+        # Base URL of the scoring service
+        self._url = url.rstrip("/")
+
+
+    def estimate_sharpness(self, path, x_window, y_window):
+        """ Have the service load, crop, and score an image.
+
+        The path must be valid for the service, i.e. absolute on the same
+        machine. Returns the list of scores.
+        """
+
+        reply = self._post("/sharpness", {"path": path, "x_window": x_window,
+                                          "y_window": y_window})
+        return reply["score"]
+
+
+    def fit_gaussian(self, adjustment, sharpness):
+        """ Have the service fit a Gaussian to the sharpness values.
+
+        Raises ValueError or RuntimeError just like the local fit does.
+        """
+
+        reply = self._post("/fit", {"adjustment": [float(a) for a in adjustment],
+                                    "sharpness": [float(s) for s in sharpness]})
+        return reply["params"]
+
+
+    def _post(self, endpoint, payload):
+        """ Send a request and return the decoded reply, re-raising errors.
+
+        Problems with the image or the fit raise ValueError or RuntimeError,
+        problems reaching or talking to the service raise IOError.
+        """
+
+        request = Request(self._url + endpoint, json.dumps(payload).encode("utf-8"),
+                          {"Content-Type": "application/json"})
+        try:
+            body = urlopen(request).read()
+        except HTTPError as error:
+            # Errors come with a reply of their own
+            body = error.read()
+        try:
+            reply = json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise IOError("Scoring service sent an unreadable reply")
+
+        if reply.get("error") == "value":
+            raise ValueError(reply.get("message"))
+        if reply.get("error") == "runtime":
+            raise RuntimeError(reply.get("message"))
+        if "error" in reply:
+            raise IOError("Scoring service failed: {0}".format(reply.get("message")))
+        return reply
+
+
+class _Job(object):
+    """ A single image waiting to be scored. """
+
+
+    def __init__(self, path, x_window, y_window):
+        self.path = path
+        self.x_window = x_window
+        self.y_window = y_window
+        self.score = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Translates HTTP requests into calls to the ScoringServer. """
+
+
+    def do_POST(self):
+        """ Handle /sharpness and /fit requests. """
+
+        status = 200
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+
+            if self.path == "/sharpness":
+                reply = self.server.scoring.sharpness(request)
+            elif self.path == "/fit":
+                reply = self.server.scoring.fit(request)
+            else:
+                status = 404
+                reply = {"error": "request", "message": "Unknown endpoint {0}".format(self.path)}
+        except (ValueError, KeyError, TypeError) as error:
+            status = 400
+            reply = {"error": "request", "message": "Bad request: {0}".format(error)}
+        except Exception as error:
+            status = 500
+            reply = {"error": "server", "message": str(error)}
+
+        body = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        """ Keep the console quiet. """
+        pass
+
+
+def _require(request, *keys):
+    """ Make sure a request has all the keys we need. """
+
+    missing = [key for key in keys if key not in request]
+    if missing:
+        raise ValueError("missing {0}".format(", ".join(missing)))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ Answer each connection in a thread, so requests can pile up into
+    batches.
+    """
+
+    daemon_threads = True
+
+
+class ScoringServer(object):
+    """ A long running local service scoring images for several clients.
+
+    Requests are collected into small batches which are scored together.
+    FFT regions stay cached in Core, recent scores (e.g. of reference
+    images) are cached here.
+    """
+
+
+    def __init__(self, host="127.0.0.1", port=8765, batch_size=8, batch_wait=0.05,
+                 cache_size=64):
+        # Only import the heavy bits where they are needed
+        from calmadju.core import Core
+        from calmadju.image_helper import Image
+        self._core = Core
+        self._image = Image
+
+        # Largest batch and how long (in s) to wait for it to fill up
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        # Scores of recently seen images
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        # Jobs waiting to be scored
+        self._queue = Queue()
+        # Some numbers on what we did
+        self._stats = {"requests": 0, "batches": 0, "scored": 0, "cache_hits": 0}
+        self._stats_lock = threading.Lock()
+
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.scoring = self
+
+        self._worker = threading.Thread(target=self._work)
+        self._worker.daemon = True
+
+
+    @property
+    def url(self):
+        """ URL the service listens on. """
+
+        return "http://{0}:{1}".format(*self._httpd.server_address[:2])
+
+
+    def stats(self):
+        """ Return counts of requests, batches, scored images, and cache hits. """
+
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+    def shutdown(self):
+        """ Stop serving (call from another thread than serve_forever). """
+
+        self._httpd.shutdown()
+
+
+    def serve_forever(self):
+        """ Start scoring and answer requests until interrupted. """
+
+        self._worker.start()
+        print("Scoring service listening on {0}".format(self.url))
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self._httpd.server_close()
+
+
+    def sharpness(self, request):
+        """ Queue an image for scoring and wait for the result. """
+
+        _require(request, "path", "x_window", "y_window")
+        job = _Job(str(request["path"]), int(request["x_window"]), int(request["y_window"]))
+        if job.x_window <= 0 or job.y_window <= 0:
+            raise ValueError("window must be positive")
+        with self._stats_lock:
+            self._stats["requests"] += 1
+        self._queue.put(job)
+        job.done.wait()
+
+        if job.error is not None:
+            return {"error": "value", "message": job.error}
+        return {"score": [float(value) for value in job.score]}
+
+
+    def fit(self, request):
+        """ Fit a Gaussian to the given sharpness values. """
+
+        _require(request, "adjustment", "sharpness")
+        adjustment = [float(value) for value in request["adjustment"]]
+        sharpness = [float(value) for value in request["sharpness"]]
+        if len(adjustment) != len(sharpness):
+            raise ValueError("adjustment and sharpness differ in length")
+
+        try:
+            popt = self._core.fit_gaussian(adjustment, sharpness)
+        except ValueError as error:
+            return {"error": "value", "message": str(error)}
+        except RuntimeError as error:
+            return {"error": "runtime", "message": str(error)}
+        return {"params": [float(value) for value in popt]}
+
+
+    def _work(self):
+        """ Collect jobs into batches and score them, forever. """
+
+        while True:
+            jobs = [self._queue.get()]
+            deadline = time.time() + self._batch_wait
+            while len(jobs) < self._batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+
+            try:
+                self._score_batch(jobs)
+            except Exception as error:
+                # Don't let one bad batch stop the service
+                for job in jobs:
+                    if job.score is None and job.error is None:
+                        job.error = str(error)
+            for job in jobs:
+                job.done.set()
+
+
+    def _score_batch(self, jobs):
+        """ Score a batch of jobs, using cached results where possible. """
+
+        todo = []
+        crops = []
+        for job in jobs:
+            try:
+                key = (job.path, os.path.getmtime(job.path), job.x_window, job.y_window)
+            except OSError:
+                job.error = "Cannot read {0}".format(job.path)
+                continue
+
+            with self._cache_lock:
+                if key in self._cache:
+                    job.score = self._cache[key]
+                    with self._stats_lock:
+                        self._stats["cache_hits"] += 1
+                    continue
+
+            image = self._image()
+            try:
+                image.read(os.path.dirname(job.path), os.path.basename(job.path))
+            except IOError as error:
+                job.error = str(error)
+                continue
+            image.crop(job.x_window, job.y_window, release=True)
+            if image.cropped_img.size == 0:
+                job.error = "Window does not fit into {0}".format(job.path)
+                continue
+            crops.append(image.cropped_img)
+            todo.append((job, key))
+
+        if crops:
+            scores = self._core.score_crops(crops)
+            with self._stats_lock:
+                self._stats["batches"] += 1
+                self._stats["scored"] += len(crops)
+            del crops
+            with self._cache_lock:
+                for (job, key), score in zip(todo, scores):
+                    job.score = score
+                    self._cache[key] = score
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
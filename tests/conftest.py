@@ -0,0 +1,9 @@
+"""
+This file is part of CalMAdju.
+
+Make sure plots don't need a display.
+"""
+
+import matplotlib
+
+matplotlib.use("Agg")
@@ -0,0 +1,122 @@
+"""
+This file is part of CalMAdju.
+
+Tests for the camera config layer, against a recorded config dump.
+"""
+
+import os
+
+import pytest
+
+from calmadju.config_helper import (CUSTOMFUNCEX_PATH, MODEL_PATH, CameraConfig,
+                                    find_changed_value, locate_customfuncex_value,
+                                    parse_config)
+
+DUMP = os.path.join(os.path.dirname(__file__), "data", "canon_eos_7d_config.txt")
+
+CUSTOMFUNCEX = ("c4,1,3,b8,d,502,1,1,504,1,0,503,1,0,505,1,0,507,5,2,2,{0},2,0,512,2,0,"
+                "17,513,1,1,510,1,0,514,1,0,515,1,0,50e,1,0,516,1,1,60f,1,0,")
+
+
+class FakeGphoto(object):
+    """ Answers gphoto2 calls from the recorded dump, keeping track of them. """
+
+    def __init__(self):
+        with open(DUMP) as dump:
+            self.lines = dump.read().splitlines()
+        self.config = parse_config(self.lines)
+        self.calls = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args[0])
+        if args[0] == "--list-all-config":
+            return self.lines
+        path = args[0].split("=", 1)[1]
+        return ["Label: whatever", "Current: {0}".format(self.config[path]["current"])]
+
+
+def test_parse_config():
+    with open(DUMP) as dump:
+        config = parse_config(dump)
+
+    assert list(config)[0] == "/main/actions/syncdatetime"
+    assert config[MODEL_PATH]["current"] == "Canon EOS 7D"
+    assert config["/main/settings/capturetarget"]["type"] == "RADIO"
+    assert config["/main/settings/capturetarget"]["choices"] == ["0 Internal RAM",
+                                                                 "1 Memory card"]
+    assert config[CUSTOMFUNCEX_PATH]["current"] == CUSTOMFUNCEX.format("0")
+
+
+def test_patch_af_microadjustment():
+    config = CameraConfig.from_dump(DUMP)
+
+    assert config.can_set_af_microadjustment()
+    assert config.af_microadjustment_customfuncex(-20) == CUSTOMFUNCEX.format("ec")
+    assert config.af_microadjustment_customfuncex(5) == CUSTOMFUNCEX.format("05")
+    assert config.get(CUSTOMFUNCEX_PATH) == CUSTOMFUNCEX.format("05")
+    assert config.matches_customfuncex(CUSTOMFUNCEX.format("5"))
+
+
+def test_unconfirmed_layouts_are_not_used():
+    with open(DUMP) as dump:
+        config = parse_config(dump)
+    config[MODEL_PATH]["current"] = "Canon EOS 5D Mark III"
+    assert not CameraConfig(config).can_set_af_microadjustment()
+
+    # A confirmed camera with an unexpected layout
+    config[MODEL_PATH]["current"] = "Canon EOS 7D"
+    config[CUSTOMFUNCEX_PATH]["current"] = CUSTOMFUNCEX.replace("507,5,2,2,{0},2,0",
+                                                                "507,3,2,2,{0}").format("0")
+    assert not CameraConfig(config).can_set_af_microadjustment()
+
+    with pytest.raises(ValueError):
+        locate_customfuncex_value("c4,1,3,b8,d,502", 0x507, 5, 2)
+
+
+def test_from_camera_caches_per_body_and_firmware(tmp_path):
+    cache_dir = str(tmp_path)
+
+    gp = FakeGphoto()
+    config = CameraConfig.from_camera(gp, cache_dir)
+    assert "--list-all-config" in gp.calls
+    assert os.listdir(cache_dir) == ["Canon_EOS_7D_3-2.0.6.json"]
+    assert config.can_set_af_microadjustment()
+
+    # The camera's custom functions changed since we cached its config
+    gp = FakeGphoto()
+    gp.config[CUSTOMFUNCEX_PATH]["current"] = CUSTOMFUNCEX.format("3")
+    config = CameraConfig.from_camera(gp, cache_dir)
+    assert "--list-all-config" not in gp.calls
+    assert "--get-config={0}".format(CUSTOMFUNCEX_PATH) in gp.calls
+    assert config.matches_customfuncex(CUSTOMFUNCEX.format("3"))
+    assert config.af_microadjustment_customfuncex(-5) == CUSTOMFUNCEX.format("fb")
+
+
+def test_find_changed_value():
+    # As in doc/How_to_find_the_custom_AF_adjustment_setting_with_gphoto2.md
+    assert find_changed_value(CUSTOMFUNCEX.format("0"), CUSTOMFUNCEX.format("5"), 0, 5) == \
+        (0x507, 5, 2)
+
+    with pytest.raises(ValueError):
+        # Nothing changed
+        find_changed_value(CUSTOMFUNCEX.format("0"), CUSTOMFUNCEX.format("0"), 0, 5)
+    with pytest.raises(ValueError):
+        # Something else changed as well
+        find_changed_value(CUSTOMFUNCEX.format("0"),
+                           CUSTOMFUNCEX.format("5").replace("502,1,1", "502,1,0"), 0, 5)
+    with pytest.raises(ValueError):
+        # Changed to something the user was not asked to set
+        find_changed_value(CUSTOMFUNCEX.format("0"), CUSTOMFUNCEX.format("3"), 0, 5)
+
+
+def test_learned_layout_is_used():
+    with open(DUMP) as dump:
+        config = parse_config(dump)
+    config[MODEL_PATH]["current"] = "Canon EOS 5D Mark III"
+    camera_config = CameraConfig(config)
+    assert not camera_config.can_set_af_microadjustment()
+
+    camera_config.learn_af_microadjustment(CUSTOMFUNCEX.format("0"), CUSTOMFUNCEX.format("5"),
+                                           0, 5)
+    assert camera_config.can_set_af_microadjustment()
+    assert camera_config.af_microadjustment_customfuncex(-1) == CUSTOMFUNCEX.format("ff")
@@ -0,0 +1,83 @@
+"""
+This file is part of CalMAdju.
+
+Tests for streaming previously taken images through the analysis.
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from calmadju.core import Core
+
+
+def write_shots(directory, values, black=()):
+    """ Write textured test shots (black ones for the given values) and a
+    reference image that must not be picked up.
+    """
+
+    rng = np.random.RandomState(0)
+    target = (rng.rand(60, 80) * 255).astype(np.uint8)
+    for value in values:
+        image = np.zeros_like(target) if value in black else target
+        cv2.imwrite(str(directory / "AFtest_iter_0_adj_{0}.jpg".format(value)), image)
+    cv2.imwrite(str(directory / "reference.jpg"), target)
+
+
+def make_core(tmp_path, **kwargs):
+    images = tmp_path / "images"
+    images.mkdir()
+    return images, Core(base_dir=str(images), batch_mode=True,
+                        results_dir=str(tmp_path / "results"), window=(20, 15), **kwargs)
+
+
+def test_iter_image_files_skips_other_files(tmp_path):
+    images, core = make_core(tmp_path)
+    write_shots(images, [-2, 0, 2])
+    (images / "notes.txt").write_text(u"not an image")
+
+    assert sorted(core.iter_image_files()) == [("AFtest_iter_0_adj_-2.jpg", -2),
+                                               ("AFtest_iter_0_adj_0.jpg", 0),
+                                               ("AFtest_iter_0_adj_2.jpg", 2)]
+
+
+def test_stream_sharpness_writes_rows_as_it_goes(tmp_path):
+    images, core = make_core(tmp_path, prescreen=False)
+    write_shots(images, [0, 2])
+
+    results = list(core.stream_sharpness(core.iter_image_files()))
+
+    assert [(filename, value) for filename, value, _ in results] == \
+        [("AFtest_iter_0_adj_0.jpg", 0), ("AFtest_iter_0_adj_2.jpg", 2)]
+    lines = (tmp_path / "results" / "sharpness.csv").read_text().splitlines()
+    assert lines[0] == "filename,adjustment,variance,gradient,fft,status"
+    assert len(lines) == 3
+    for line, (_, _, score) in zip(lines[1:], results):
+        fields = line.split(",")
+        assert fields[-1] == "ok"
+        assert np.allclose([float(field) for field in fields[2:5]], score, rtol=1e-6)
+    # Nothing ends up in the image archive
+    assert not (images / "sharpness.csv").exists()
+
+
+def test_stream_sharpness_marks_rejected_frames(tmp_path):
+    images, core = make_core(tmp_path)
+    write_shots(images, [0, 2, 4, 6, 8], black=(8,))
+
+    results = list(core.stream_sharpness(core.iter_image_files()))
+
+    assert [score is None for _, _, score in results] == [False] * 4 + [True]
+    lines = (tmp_path / "results" / "sharpness.csv").read_text().splitlines()
+    assert lines[-1] == "AFtest_iter_0_adj_8.jpg,8,,,,rejected"
+
+
+def test_fit_needs_three_points(tmp_path):
+    _, core = make_core(tmp_path)
+
+    with pytest.raises(ValueError):
+        Core.fit_gaussian([0, 2], [1., 1.])
+
+    core._adjustment = [0, 2]
+    core._sharpness = [1., 1.]
+    assert core.find_best_madj() == 0
+    assert core._fit_params is None
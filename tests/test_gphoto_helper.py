@@ -0,0 +1,151 @@
+"""
+This file is part of CalMAdju.
+
+Tests for setting the AF microadjustment through a fake gphoto2.
+"""
+
+import json
+import os
+import re
+
+import pytest
+
+import calmadju.gphoto_helper as gphoto_helper
+from calmadju.config_helper import CUSTOMFUNCEX_PATH, FIRMWARE_PATH, MODEL_PATH, hex_value
+from calmadju.gphoto_helper import Gphoto
+
+CUSTOMFUNCEX_7D = ("c4,1,3,b8,d,502,1,1,504,1,0,503,1,0,505,1,0,507,5,2,2,{0},2,0,512,2,0,"
+                   "17,513,1,1,510,1,0,514,1,0,515,1,0,50e,1,0,516,1,1,60f,1,0,")
+# A body nobody confirmed, with its AF microadjustment somewhere else
+CUSTOMFUNCEX_OTHER = "40,1,3,20,3,502,1,1,50a,3,1,{0},0,60f,1,0,"
+
+
+class FakeCamera(object):
+    """ Pretends to be gphoto2 talking to a camera. """
+
+    def __init__(self, model, customfuncex, reject=False, garble=False):
+        self.model = model
+        self.template = customfuncex
+        self.current = customfuncex.format(hex_value(0))
+        # What to do with the first write
+        self.reject = reject
+        self.garble = garble
+        self.writes = []
+
+    def __call__(self, *args, **kwargs):
+        command = args[0]
+        if isinstance(command, list):
+            command = command[0]
+
+        if command == "--auto-detect":
+            return ["Model                          Port",
+                    "----------------------------------------------------------",
+                    "{0}                   usb:001,005".format(self.model)]
+        if command == "--list-all-config":
+            lines = []
+            for path, value in self.config().items():
+                lines.extend([path, "Label: x", "Type: TEXT", "Current: {0}".format(value), "END"])
+            return lines
+        if command.startswith("--get-config="):
+            return ["Label: x", "Current: {0}".format(self.config()[command.split("=", 1)[1]])]
+        if command.startswith("--set-config=customfuncex="):
+            value = command.split("=", 2)[2]
+            self.writes.append(value)
+            if len(self.writes) == 1 and self.reject:
+                raise Exception("camera said no")
+            if len(self.writes) == 1 and self.garble:
+                # Half of it arrived, messing up another custom function
+                tokens = value.split(",")
+                tokens[7] = "0"
+                value = ",".join(tokens)
+            self.current = value
+            return []
+        raise AssertionError("unexpected gphoto2 call {0}".format(args))
+
+    def config(self):
+        return {MODEL_PATH: self.model, FIRMWARE_PATH: "1.0",
+                CUSTOMFUNCEX_PATH: self.current}
+
+    def prompt(self, print_msg="", override=False):
+        """ Stands in for the user: does what the prompt asks for. """
+        match = re.search(r"set the AF microadjustment to (-?\d+)", print_msg)
+        if match:
+            self.current = self.template.format(hex_value(int(match.group(1))))
+
+
+def attach(monkeypatch, tmp_path, camera, batch_mode=False):
+    monkeypatch.setattr(gphoto_helper, "gp", camera)
+    gphoto = Gphoto(str(tmp_path), batch_mode=batch_mode, cameraless_mode=False,
+                    camerasafe_mode=False, config_cache_dir=str(tmp_path / "cache"))
+    gphoto.wait_key = camera.prompt
+    gphoto.find_camera()
+    return gphoto
+
+
+def test_unknown_body_learns_and_caches_its_layout(monkeypatch, tmp_path):
+    camera = FakeCamera("Canon EOS 5D Mark III", CUSTOMFUNCEX_OTHER)
+    gphoto = attach(monkeypatch, tmp_path, camera)
+
+    assert gphoto._auto_cam
+    gphoto.set_af_microadjustment(-3)
+    assert camera.current == CUSTOMFUNCEX_OTHER.format("fd")
+    assert camera.writes == [CUSTOMFUNCEX_OTHER.format("fd")]
+
+    with open(str(tmp_path / "cache" / "Canon_EOS_5D_Mark_III_1.0.json")) as cache:
+        assert json.load(cache)["af_microadjustment"] == [0x50a, 3, 1]
+
+    # Next time the cache knows, no questions asked (even in batch mode)
+    gphoto = attach(monkeypatch, tmp_path, camera, batch_mode=True)
+    assert gphoto._auto_cam
+    gphoto.set_af_microadjustment(7)
+    assert camera.current == CUSTOMFUNCEX_OTHER.format("07")
+
+
+def test_unknown_body_in_batch_mode_stays_manual(monkeypatch, tmp_path):
+    camera = FakeCamera("Canon EOS 5D Mark III", CUSTOMFUNCEX_OTHER)
+    gphoto = attach(monkeypatch, tmp_path, camera, batch_mode=True)
+
+    assert not gphoto._auto_cam
+
+
+@pytest.mark.parametrize("failure", ["reject", "garble"])
+def test_failed_write_is_undone(monkeypatch, tmp_path, capsys, failure):
+    camera = FakeCamera("Canon EOS 7D", CUSTOMFUNCEX_7D, **{failure: True})
+    gphoto = attach(monkeypatch, tmp_path, camera)
+    original = camera.current
+    assert gphoto._auto_cam
+
+    gphoto.set_af_microadjustment(4)
+
+    assert camera.writes == [CUSTOMFUNCEX_7D.format("04"), original]
+    assert camera.current == original
+    assert not gphoto._auto_cam
+    out = capsys.readouterr().out
+    assert "Restored the previous custom functions" in out
+    assert "Please change the microadjustment level to 4" in out
+
+
+def test_verified_write_is_not_read_back_again(monkeypatch, tmp_path):
+    camera = FakeCamera("Canon EOS 7D", CUSTOMFUNCEX_7D)
+    gphoto = attach(monkeypatch, tmp_path, camera)
+
+    gphoto.set_af_microadjustment(4)
+    gphoto.set_af_microadjustment(-4)
+
+    assert gphoto._auto_cam
+    assert camera.current == CUSTOMFUNCEX_7D.format("fc")
+    assert os.listdir(str(tmp_path / "cache")) == ["Canon_EOS_7D_1.0.json"]
+
+
+def test_known_template_without_usable_config(monkeypatch, tmp_path):
+    # The camera offers no customfuncex in its config tree, the 7D template
+    # is used as before
+    camera = FakeCamera("Canon EOS 7D", CUSTOMFUNCEX_7D)
+    camera.config = lambda: {MODEL_PATH: camera.model, FIRMWARE_PATH: "1.0"}
+    gphoto = attach(monkeypatch, tmp_path, camera)
+
+    assert gphoto._auto_cam
+    gphoto.set_af_microadjustment(-20)
+    assert camera.writes[-1] == ("c4,1,3,b8,d,502,1,0,504,1,0,503,1,0,505,1,0,507,5,2,2,"
+                                 "ec,2,0,512,2,0,17,513,1,1,510,1,0,514,1,0,515,1,0,50e,"
+                                 "1,0,516,1,1,60f,1,0,")
@@ -0,0 +1,39 @@
+"""
+This file is part of CalMAdju.
+
+Tests for loading and cropping images.
+"""
+
+import numpy as np
+import pytest
+
+from calmadju.image_helper import Image
+
+
+def make_image(height=60, width=80):
+    image = Image()
+    image.img = np.arange(height * width, dtype=np.uint32).reshape(height, width)
+    return image
+
+
+def test_crop_release_keeps_a_copy_only():
+    image = make_image()
+    full = image.img
+    image.crop(10, 5, release=True)
+
+    assert image.img is None
+    assert image.cropped_img.shape == (10, 20)
+    assert not np.shares_memory(image.cropped_img, full)
+    assert np.array_equal(image.cropped_img, full[25:35, 30:50])
+
+
+def test_crop_is_limited_to_the_image():
+    image = make_image()
+    image.crop(900, 2000)
+
+    assert np.array_equal(image.cropped_img, image.img)
+
+
+def test_crop_rejects_empty_window():
+    with pytest.raises(ValueError):
+        make_image().crop(0, 0)
@@ -0,0 +1,149 @@
+"""
+This file is part of CalMAdju.
+
+Tests for rejecting bad frames early, and retaking them.
+"""
+
+import cv2
+import numpy as np
+
+from calmadju.core import Core
+from calmadju.image_helper import Image
+from calmadju.prescreen_helper import Prescreen
+
+RNG = np.random.RandomState(1)
+TARGET = RNG.rand(64, 96)
+
+
+def frame(brightness=128., contrast=1.):
+    """ An Image with a cropped textured frame of the given mean brightness. """
+
+    image = Image()
+    image.cropped_img = np.clip(brightness + (TARGET - 0.5) * 100. * contrast,
+                                0, 255).astype(np.uint8)
+    return image
+
+
+def warm_up(prescreen, n=3):
+    for i in range(n):
+        assert prescreen.check(frame(128. + i, 1. - 0.01 * i)) == (True, None)
+
+
+def test_first_frames_are_always_accepted():
+    prescreen = Prescreen(min_frames=3)
+
+    # However bad they are
+    assert prescreen.check(frame(128.))[0]
+    assert prescreen.check(frame(10.))[0]
+    assert prescreen.check(frame(128., 0.05))[0]
+
+
+def test_brightness_outliers_on_both_sides():
+    prescreen = Prescreen()
+    warm_up(prescreen)
+
+    assert prescreen.check(frame(40.)) == (False, "exposure off")
+    assert prescreen.check(frame(220.)) == (False, "exposure off")
+    assert prescreen.check(frame(131.))[0]
+
+
+def test_only_drops_in_sharpness_are_rejected():
+    prescreen = Prescreen()
+    warm_up(prescreen)
+
+    assert prescreen.check(frame(128., 0.2)) == (False, "out of focus")
+    # Sharper than the rest is fine, that's what we're looking for
+    assert prescreen.check(frame(128., 1.5))[0]
+    # As is the moderate change over a sweep
+    assert prescreen.check(frame(128., 0.8))[0]
+
+
+def test_constant_frames():
+    # All frames the same, so the median absolute deviation is zero
+    prescreen = Prescreen()
+    for _ in range(5):
+        assert prescreen.check(frame(128.))[0]
+
+    # The relative tolerances still apply
+    assert prescreen.check(frame(128.))[0]
+    assert prescreen.check(frame(135.))[0]
+    assert not prescreen.check(frame(100.))[0]
+    assert not prescreen.check(frame(128., 0.3))[0]
+
+
+def test_summary(capsys):
+    prescreen = Prescreen()
+    warm_up(prescreen)
+    prescreen.check(frame(40.))
+    prescreen.check(frame(129.))
+    prescreen.add_full_time(1.5)
+    prescreen.add_full_time(2.5)
+
+    prescreen.summary()
+
+    out = capsys.readouterr().out
+    assert "rejected 1 of 5 frames (20%)" in out
+    assert "saving about 2.00s of full resolution scoring" in out
+
+
+class FakeCamera(object):
+    """ Stands in for Gphoto, 'taking' pictures that are black for the given
+    filenames.
+    """
+
+    def __init__(self, base_dir, black):
+        self.base_dir = base_dir
+        self.black = black
+        self.taken = []
+        self.value = 0
+
+    def check_version(self):
+        pass
+
+    def find_camera(self):
+        pass
+
+    def prepare_camera(self):
+        pass
+
+    def set_af_microadjustment(self, value):
+        self.value = value
+
+    def get_image(self, filename):
+        self.taken.append(filename)
+        if filename in self.black:
+            image = np.zeros_like(TARGET, dtype=np.uint8)
+        else:
+            # Sharpest around 0
+            image = frame(128., 1. - abs(self.value) / 100.).cropped_img
+        cv2.imwrite(str(self.base_dir / filename), image)
+
+    def camera_model(self):
+        return "Fake camera"
+
+    def lens_name(self):
+        return "Fake lens"
+
+
+def test_rejected_frames_are_retaken(tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    core = Core(base_dir=str(images), batch_mode=True, results_dir=str(tmp_path / "results"),
+                gp_cameraless_mode=False, gp_camerasafe_mode=False, window=(40, 30))
+    camera = FakeCamera(images, black=["AFtest_iter_0_adj_8.jpg", "AFtest_iter_1_adj_8.jpg",
+                                       "AFtest_iter_0_adj_10.jpg"])
+    core._gphoto = camera
+    core.find_center = lambda: None
+    core.wait_key = lambda *args, **kwargs: None
+
+    core.main()
+
+    assert camera.taken[-2:] == ["AFtest_iter_1_adj_8.jpg", "AFtest_iter_1_adj_10.jpg"]
+    assert core._rejected == [8, 10, 8]
+    assert core._skipped == [8]
+    assert 10 in core._adjustment
+    assert 8 not in core._adjustment
+
+    record = core._results.load_sweep(core._results.query(camera="Fake camera")["sweep"][0])
+    assert list(record["rejected"]) == [8, 10, 8]
+    assert list(record["skipped"]) == [8]
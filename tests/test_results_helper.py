@@ -0,0 +1,45 @@
+"""
+This file is part of CalMAdju.
+
+Tests for the sweep records and their index.
+"""
+
+import time
+
+import numpy as np
+
+from calmadju.results_helper import Results
+
+
+def test_sweeps_in_the_same_second_are_kept(tmp_path):
+    results = Results(str(tmp_path))
+    now = time.time()
+
+    first = results.write_sweep("Canon EOS 7D", "EF 50mm", 50., [-2, 0, 2],
+                                [[1., 1., 1.], [2., 2., 2.], [1., 1., 1.]],
+                                [2., 0., 1.], 0, timestamp=now)
+    second = results.write_sweep("Canon EOS 7D", "EF 50mm", 50., [-2, 0, 2],
+                                 [[1., 1., 1.], [1., 1., 1.], [2., 2., 2.]],
+                                 [2., 2., 1.], 2, timestamp=now)
+
+    assert first != second
+    assert results.load_sweep(first)["optimum"] == 0
+    assert results.load_sweep(second)["optimum"] == 2
+
+    rows = results.query(camera="Canon EOS 7D")
+    assert sorted(rows["sweep"]) == sorted([first, second])
+    assert not (tmp_path / "index.lock").exists()
+
+
+def test_query_filters_by_camera_and_lens(tmp_path):
+    results = Results(str(tmp_path))
+    results.write_sweep("Canon EOS 7D", "EF 50mm", 50., [0], [[1., 1., 1.]], None,
+                        np.nan, timestamp=1000.)
+    results.write_sweep("Canon EOS 7D", "EF 85mm", 85., [0], [[1., 1., 1.]], None,
+                        np.nan, timestamp=2000.)
+    results.write_sweep("Canon EOS 5D", "EF 50mm", 50., [0], [[1., 1., 1.]], None,
+                        np.nan, timestamp=3000.)
+
+    assert len(results.query(camera="Canon EOS 7D")["sweep"]) == 2
+    assert list(results.query(camera="Canon EOS 7D", lens="EF 85mm")["focal_length"]) == [85.]
+    assert len(results.query(camera="Nikon D800")["sweep"]) == 0
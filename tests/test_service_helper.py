@@ -0,0 +1,118 @@
+"""
+This file is part of CalMAdju.
+
+Tests for the local scoring service, all on this machine.
+"""
+
+import os
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from calmadju.core import Core
+from calmadju.image_helper import Image
+from calmadju.service_helper import RemoteScorer, ScoringServer
+
+X_WINDOW = 24
+Y_WINDOW = 16
+
+
+@pytest.fixture
+def images(tmp_path):
+    """ Write a few small greyscale images, sharp and increasingly blurred. """
+
+    rng = np.random.RandomState(42)
+    target = (rng.rand(60, 80) * 255).astype(np.uint8)
+    paths = []
+    for i, blur in enumerate([1, 3, 5, 7]):
+        image = cv2.GaussianBlur(target, (blur, blur), 0)
+        path = str(tmp_path / "image_{0}.png".format(i))
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def server():
+    """ Run a scoring service on a free port, waiting a while to fill batches. """
+
+    service = ScoringServer(port=0, batch_size=8, batch_wait=0.5)
+    thread = threading.Thread(target=service.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield service
+    service.shutdown()
+    thread.join(5)
+
+
+def local_score(path):
+    image = Image(*os.path.split(path))
+    image.crop(X_WINDOW, Y_WINDOW)
+    return Core.score_crop(image.cropped_img)
+
+
+def test_concurrent_requests_are_batched_and_match_local_scores(server, images):
+    scores = {}
+
+    def score(path):
+        scores[path] = RemoteScorer(server.url).estimate_sharpness(path, X_WINDOW, Y_WINDOW)
+
+    threads = [threading.Thread(target=score, args=(path,)) for path in images]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    for path in images:
+        assert np.allclose(scores[path], local_score(path), rtol=1e-5)
+
+    stats = server.stats()
+    assert stats["requests"] == len(images)
+    assert stats["scored"] == len(images)
+    assert stats["batches"] < len(images)
+
+
+def test_repeated_request_hits_cache(server, images):
+    scorer = RemoteScorer(server.url)
+    first = scorer.estimate_sharpness(images[0], X_WINDOW, Y_WINDOW)
+    second = scorer.estimate_sharpness(images[0], X_WINDOW, Y_WINDOW)
+
+    assert first == second
+    stats = server.stats()
+    assert stats["scored"] == 1
+    assert stats["cache_hits"] == 1
+
+
+def test_fit(server):
+    adjustment = np.arange(-10., 11., 2.)
+    sharpness = Core.fit_function(adjustment, 2., 3., 20.)
+
+    params = RemoteScorer(server.url).fit_gaussian(list(adjustment), list(sharpness))
+
+    assert np.allclose(params, [2., 3., 20.], rtol=1e-3)
+
+
+def test_bad_requests_get_a_reply(server, tmp_path, capfd):
+    scorer = RemoteScorer(server.url)
+
+    with pytest.raises(ValueError):
+        # Too few points for a fit
+        scorer.fit_gaussian([0.], [1.])
+    with pytest.raises(ValueError):
+        scorer.estimate_sharpness(str(tmp_path / "missing.png"), X_WINDOW, Y_WINDOW)
+    with pytest.raises(IOError):
+        # No path at all
+        scorer._post("/sharpness", {"x_window": X_WINDOW, "y_window": Y_WINDOW})
+    with pytest.raises(IOError):
+        scorer._post("/nowhere", {})
+
+    # The service is still alive and didn't claim to exit
+    assert server.stats()["requests"] == 1
+    assert "Exiting" not in capfd.readouterr().out
+
+
+def test_unreachable_service_raises_ioerror():
+    with pytest.raises(IOError):
+        RemoteScorer("http://127.0.0.1:9").estimate_sharpness("/nowhere.png", 1, 1)